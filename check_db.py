@@ -10,6 +10,7 @@ Stampa tabelle disponibili, colonne e 5 righe di esempio per:
 Usa DATABASE_URL (Postgres, ecc.) oppure fallback a SQLite in data/weather.db.
 """
 
+import functools
 import os
 import re
 import sys
@@ -17,11 +18,15 @@ import pandas as pd
 from sqlalchemy import create_engine, inspect
 from dotenv import load_dotenv
 
+_MASK_RE = re.compile(r"://([^:]+):([^@]+)@")
+
+@functools.lru_cache(maxsize=8)
 def mask_url(u: str) -> str:
     if not u:
         return u
-    return re.sub(r"://([^:]+):([^@]+)@", r"://\\1:***@", u)
+    return _MASK_RE.sub(r"://\1:***@", u)
 
+@functools.lru_cache(maxsize=8)
 def normalize_db_url(raw: str) -> str:
     u = (raw or "").strip()
     if not u:
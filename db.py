@@ -1,8 +1,11 @@
+import io
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import column, create_engine, event, quoted_name, table as table_clause
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
 
-_ENGINE_CACHE: dict[tuple[str, bool], Engine] = {}
+_ENGINE_CACHE: dict[tuple[str, bool, bool], Engine] = {}
+_SCHEMA_ENSURED: set[str] = set()
 
 def get_db_url() -> str:
     url = (os.getenv("DATABASE_URL") or "").strip()
@@ -18,26 +21,144 @@ def get_db_url() -> str:
     sqlite_path = (os.getenv("SQLITE_PATH") or "data/weather.db").strip()
     return f"sqlite:///{sqlite_path}"
 
-def get_engine(echo: bool = False) -> Engine:
-    """Ritorna un Engine riusabile (cache per url+echo)."""
+def engine_options(db_url: str) -> dict:
+    """Opzioni create_engine per driver: executemany veloce su psycopg2, thread condivisi su SQLite."""
+    driver = make_url(db_url).get_dialect().driver
+    if driver == "psycopg2":
+        return {
+            "executemany_mode": "values_plus_batch",
+            "executemany_batch_page_size": 500,
+            "insertmanyvalues_page_size": 1000,
+        }
+    if db_url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+    return {}
+
+def enable_sqlite_wal(eng: Engine) -> None:
+    """WAL + synchronous=NORMAL su ogni connessione SQLite: gli upsert bulk non attendono un fsync per commit.
+
+    Solo per gli ingest che scrivono (il journal_mode resta nel file .db): a fine scrittura
+    chiamare sqlite_checkpoint, così nulla resta nel -wal quando il .db viene copiato o committato.
+    """
+    if eng.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(eng, "connect")
+    def _set_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+
+def sqlite_explicit_begin(eng: Engine) -> None:
+    """Il BEGIN lo emette SQLAlchemy (ricetta pysqlite): senza, RELEASE del primo SAVEPOINT
+    committa da solo e begin_nested() non sta dentro la transazione di engine.begin()."""
+    if eng.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(eng, "connect")
+    def _no_driver_begin(dbapi_conn, _record):
+        dbapi_conn.isolation_level = None
+
+    @event.listens_for(eng, "begin")
+    def _do_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+def sqlite_checkpoint(eng: Engine) -> None:
+    """Riporta nel file .db le pagine del -wal e lo svuota (PRAGMA wal_checkpoint(TRUNCATE))."""
+    if eng.dialect.name != "sqlite":
+        return
+    raw = eng.raw_connection()
+    try:
+        # connessione DBAPI fuori da transazioni: il checkpoint non resta bloccato da un BEGIN aperto
+        raw.driver_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        raw.close()
+
+def get_engine(echo: bool = False, wal: bool = False) -> Engine:
+    """Ritorna un Engine riusabile (cache per url+echo+wal); wal=True solo per gli ingest che scrivono."""
     db_url = get_db_url()
-    key = (db_url, bool(echo))
+    key = (db_url, bool(echo), bool(wal))
     if key in _ENGINE_CACHE:
         return _ENGINE_CACHE[key]
 
-    connect_args = {}
-    if db_url.startswith("sqlite"):
-        connect_args["check_same_thread"] = False
-
-    eng = create_engine(db_url, echo=echo, pool_pre_ping=True, future=True, connect_args=connect_args)
+    eng = create_engine(db_url, echo=echo, pool_pre_ping=True, future=True, **engine_options(db_url))
+    sqlite_explicit_begin(eng)
+    if wal:
+        enable_sqlite_wal(eng)
     _ENGINE_CACHE[key] = eng
     return eng
 
-def ensure_schema() -> None:
-    """Esegue schema.sql in modo idempotente (CREATE TABLE IF NOT EXISTS)."""
-    engine = get_engine()
+def exec_script(conn, ddl: str) -> None:
+    """Esegue uno script multi-statement in un solo round-trip (sqlite3 executescript, psycopg accetta ';')."""
+    if conn.dialect.name == "sqlite":
+        conn.connection.driver_connection.executescript(ddl)
+    else:
+        conn.exec_driver_sql(ddl)
+
+def ensure_schema(engine: Engine | None = None) -> None:
+    """Esegue schema.sql in modo idempotente (CREATE TABLE IF NOT EXISTS), una volta per processo e database."""
+    engine = engine or get_engine()
+    if str(engine.url) in _SCHEMA_ENSURED:
+        return
     schema_path = os.path.join(os.path.dirname(__file__), "schema.sql")
     with open(schema_path, "r", encoding="utf-8") as f:
         ddl = f.read()
     with engine.begin() as conn:
-        conn.execute(text(ddl))
+        exec_script(conn, ddl)
+    _SCHEMA_ENSURED.add(str(engine.url))
+
+def upsert_rows(conn, table: str, records: list, pk: str = "time") -> int:
+    """Upsert di una lista di dict con l'insert() del dialetto + ON CONFLICT DO UPDATE.
+
+    Eseguito come executemany: su Postgres SQLAlchemy lo raggruppa in INSERT multi-riga
+    (insertmanyvalues, pagine da insertmanyvalues_page_size); su SQLite resta l'executemany del driver.
+    Nomi non quotati, come nello schema (Time -> time su Postgres).
+    """
+    if not records:
+        return 0
+    cols = list(records[0])
+    tbl = table_clause(table, *[column(quoted_name(c, quote=False)) for c in cols])
+    insert = postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(tbl)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[quoted_name(pk, quote=False)],
+        set_={c: stmt.excluded[c] for c in cols if c.lower() != pk.lower()},
+    )
+    conn.execute(stmt, records)
+    return len(records)
+
+def to_sql_upsert(pk: str = "time"):
+    """`method=` per DataFrame.to_sql: ogni chunk passa da upsert_rows (ON CONFLICT DO UPDATE, non INSERT semplice)."""
+    def _method(table, conn, keys, data_iter):
+        return upsert_rows(conn, table.name, [dict(zip(keys, row)) for row in data_iter], pk=pk)
+    return _method
+
+def copy_upsert(conn, df, table: str, pk: str = "time") -> int:
+    """Bulk upsert Postgres: COPY FROM STDIN in una tabella temporanea, poi INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+
+    Usa la connessione (e la transazione) già aperta; le colonne del DataFrame devono esistere in `table`.
+    Supporta psycopg2 (copy_expert) e psycopg 3 (cursor.copy).
+    """
+    cols = ", ".join(df.columns)
+    updates = ", ".join(f"{c}=excluded.{c}" for c in df.columns if c.lower() != pk.lower())
+    stage = f"{table}_stage"
+    copy_sql = f"COPY {stage} ({cols}) FROM STDIN WITH CSV"
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False)
+    buf.seek(0)
+    cur = conn.connection.cursor()
+    try:
+        cur.execute(f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        if hasattr(cur, "copy_expert"):
+            cur.copy_expert(copy_sql, buf)
+        else:
+            with cur.copy(copy_sql) as cp:
+                cp.write(buf.getvalue())
+        cur.execute(
+            f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} "
+            f"ON CONFLICT ({pk}) " + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING")
+        )
+        return len(df)
+    finally:
+        cur.close()
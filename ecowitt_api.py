@@ -1,13 +1,37 @@
 import requests
 import pandas as pd
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from units import _norm_unit, c_from, hpa_known_from, mm_from, ms_from
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except Exception:
+    import json
+    _json_loads = json.loads
 
 ECO_BASE = "https://api.ecowitt.net/api/v3"
 
+# Sessione condivisa (Ecowitt + OpenWeather): keep-alive, un handshake TLS per host invece di uno per chiamata
+SESSION = requests.Session()
+SESSION.headers.update({"Accept-Encoding": "gzip"})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4, pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset({"GET"})),
+    ),
+)
+
 def _req(endpoint, params):
-    r = requests.get(f"{ECO_BASE}/{endpoint}", params=params, timeout=30)
+    r = SESSION.get(f"{ECO_BASE}/{endpoint}", params=params, timeout=30)
     r.raise_for_status()
-    return r.json()
+    # decode diretto dai byte (orjson se disponibile): la history giornaliera ha centinaia di nodi annidati
+    return _json_loads(r.content)
 
 def get_real_time(application_key, api_key, mac, call_back="outdoor,wind,pressure,rainfall"):
     return _req("device/real_time", {
@@ -67,6 +91,16 @@ def real_time_to_df(payload):
     df = pd.DataFrame([row]).dropna(subset=["Time"])
     return df
 
+# conversione per sorgente quando il nodo riporta l'unità (es. °F, inHg, in)
+_TO_METRIC = {
+    "outdoor.temperature": c_from,
+    "pressure.relative": hpa_known_from,
+    "wind.speed_avg": ms_from,
+    "rainfall.rain_3h": mm_from,
+    "rainfall.rain_1h": mm_from,
+    "rainfall.daily": mm_from,
+}
+
 def history_to_df(payload):
     data = payload.get("data")
     # Case 1: dict of arrays
@@ -87,21 +121,41 @@ def history_to_df(payload):
         return df
     # Case 2: list of dict rows (each with time + sub-objects)
     if isinstance(data, list):
-        rows = []
-        for d in data:
-            t = pd.to_datetime(d.get("time"))
-            outdoor = d.get("outdoor", {}) or {}
-            wind = d.get("wind", {}) or {}
-            pressure = d.get("pressure", {}) or {}
-            rainfall = d.get("rainfall", {}) or {}
-            rows.append({
-                "Time": t,
-                "Temp_C": outdoor.get("temperature"),
-                "Humidity": outdoor.get("humidity"),
-                "Pressure_hPa": pressure.get("relative"),
-                "Wind_mps": wind.get("speed_avg"),
-                "WindDir": wind.get("direction"),
-                "Rain_mm": rainfall.get("rain_3h") or rainfall.get("rain_1h") or rainfall.get("daily"),
-            })
-        return pd.DataFrame(rows).dropna(subset=["Time"])
+        if not data:
+            return pd.DataFrame()
+        # un solo json_normalize per tutta la lista: colonne "outdoor.temperature", "wind.speed_avg", ...
+        flat = pd.json_normalize(data)
+        def raw(src):
+            # accetta sia il valore grezzo sia il nodo {value, unit} (anche misti nella stessa lista)
+            out = pd.Series(None, index=flat.index, dtype=object)
+            for c in (f"{src}.value", src):
+                if c in flat.columns:
+                    out = out.where(out.notna(), flat[c])
+            return out
+        def col(src):
+            # nodi con ".unit": converto alle unità delle colonne (°C, hPa, m/s, mm), vettoriale
+            out = raw(src)
+            conv = _TO_METRIC.get(src)
+            if conv is None or f"{src}.unit" not in flat.columns:
+                return out
+            v = pd.to_numeric(out, errors="coerce").to_numpy(dtype="float64")
+            return pd.Series(conv(v, flat[f"{src}.unit"].fillna("").map(_norm_unit)), index=flat.index)
+        def first_truthy(*srcs):
+            # equivalente vettoriale di `a or b or c`, deciso sui valori grezzi come prima
+            r, out = raw(srcs[0]), col(srcs[0])
+            for src in srcs[1:]:
+                falsy = r.isna() | (r.map(bool, na_action="ignore") == False)  # noqa: E712
+                r, out = r.where(~falsy, raw(src)), out.where(~falsy, col(src))
+            return out
+        df = pd.DataFrame({
+            "Time": pd.to_datetime(col("time"), errors="coerce", format="mixed"),
+            "Temp_C": col("outdoor.temperature"),
+            "Humidity": col("outdoor.humidity"),
+            "Pressure_hPa": col("pressure.relative"),
+            "Wind_mps": col("wind.speed_avg"),
+            "WindDir": col("wind.direction"),
+            "Rain_mm": first_truthy("rainfall.rain_3h", "rainfall.rain_1h", "rainfall.daily"),
+        })
+        # dtype come il vecchio DataFrame(rows): float dove i valori sono numerici
+        return df.dropna(subset=["Time"]).infer_objects()
     return pd.DataFrame()
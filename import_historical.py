@@ -1,19 +1,20 @@
 # import_historical.py
-import os
 from pathlib import Path
 import sys
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from dotenv import load_dotenv
 
+from db import copy_upsert, exec_script, get_engine, sqlite_checkpoint, upsert_rows
+
 load_dotenv()
 
-SQLITE_PATH = os.getenv("SQLITE_PATH", "./data/weather.db")
-DATABASE_URL = os.getenv("DATABASE_URL")  # usato su Actions/Render
+COPY_MIN_ROWS = 200  # sopra questa soglia, su Postgres, COPY su tabella di staging
 
 def make_engine():
-    url = DATABASE_URL if DATABASE_URL else f"sqlite:///{SQLITE_PATH}"
-    return create_engine(url, future=True)
+    # Engine condiviso di db.py: DATABASE_URL (Actions/Render) o SQLITE_PATH, in cache per processo,
+    # executemany in batch su psycopg2 e WAL su SQLite
+    return get_engine(wal=True)
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS station_3h (
@@ -69,22 +70,15 @@ def load_one(path: Path) -> pd.DataFrame:
 def upsert(df: pd.DataFrame, eng) -> int:
     if df.empty:
         return 0
-    sql = text("""
-        INSERT INTO station_3h (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, Rain_mm)
-        VALUES (:Time, :Temp_C, :Humidity, :Pressure_hPa, :Wind_kmh, :WindGust_kmh, :Rain_mm)
-        ON CONFLICT (Time) DO UPDATE SET
-            Temp_C=excluded.Temp_C,
-            Humidity=excluded.Humidity,
-            Pressure_hPa=excluded.Pressure_hPa,
-            Wind_kmh=excluded.Wind_kmh,
-            WindGust_kmh=excluded.WindGust_kmh,
-            Rain_mm=excluded.Rain_mm
-    """)
-    n = 0
     with eng.begin() as conn:
-        for _, row in df.iterrows():
-            conn.execute(sql, row.to_dict())
-            n += 1
+        if conn.dialect.name == "postgresql" and len(df) > COPY_MIN_ROWS:
+            # storici grandi: COPY FROM STDIN + INSERT ... SELECT ... ON CONFLICT
+            n = copy_upsert(conn, df, "station_3h", pk="Time")
+        else:
+            # NaN -> NULL (Postgres salverebbe 'NaN' nelle colonne REAL)
+            records = df.astype(object).where(df.notna(), None).to_dict("records")
+            # insert() del dialetto: INSERT multi-riga su Postgres, executemany su SQLite
+            n = upsert_rows(conn, "station_3h", records, pk="Time")
         conn.execute(
             text("""
                 INSERT INTO meta (k, v) VALUES ('last_ingest', :v)
@@ -99,10 +93,7 @@ def main():
     eng = make_engine()
     # Assicura schema
     with eng.begin() as conn:
-        for stmt in SCHEMA.split(";"):
-            s = stmt.strip()
-            if s:
-                conn.execute(text(s))
+        exec_script(conn, SCHEMA)
 
     # Sorgenti: preferisci cartella ./historical, altrimenti singolo file ./storico_stazione.xlsx
     files = []
@@ -128,6 +119,7 @@ def main():
             print(f"[ERRORE] {f.name}: {e}")
             sys.exit(1)
 
+    sqlite_checkpoint(eng)
     print(f"[DONE] Totale righe upsertate: {total}")
     sys.exit(0)
 
@@ -6,6 +6,8 @@ import pandas as pd
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 
+from db import exec_script
+
 load_dotenv()
 SQLITE_PATH = os.getenv("SQLITE_PATH", "./data/weather.db")
 PORT = int(os.getenv("RECEIVER_PORT", "8080"))
@@ -30,10 +32,7 @@ CREATE TABLE IF NOT EXISTS station_3h (
 );
 """
 with engine.begin() as conn:
-    for stmt in SCHEMA.split(";"):
-        s = stmt.strip()
-        if s:
-            conn.execute(text(s))
+    exec_script(conn, SCHEMA)
 
 def upsert_raw(row):
     with engine.begin() as conn:
@@ -45,6 +44,21 @@ def upsert_raw(row):
           wind_ms=excluded.wind_ms, winddir=excluded.winddir, rain_mm=excluded.rain_mm
         """), row)
 
+def aggregate_bucket_3h(ts_utc):
+    """Ricalcola solo il bucket 3h che contiene ts_utc (O(righe del bucket) invece dell'intera tabella)."""
+    fmt = "%Y-%m-%dT%H:%M:%SZ"
+    b0 = pd.Timestamp(ts_utc).floor("3h")
+    b1 = b0 + pd.Timedelta(hours=3)
+    with engine.begin() as conn:
+        conn.execute(text("""
+        INSERT INTO station_3h (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, Rain_mm)
+        SELECT :Time, AVG(temp_c), AVG(hum), AVG(press_hpa), AVG(wind_ms) * 3.6, NULL, COALESCE(SUM(rain_mm), 0)
+        FROM station_raw WHERE ts_utc >= :Time AND ts_utc < :end
+        ON CONFLICT(Time) DO UPDATE SET
+          Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
+          Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, Rain_mm=excluded.Rain_mm
+        """), {"Time": b0.strftime(fmt), "end": b1.strftime(fmt)})
+
 def aggregate_3h():
     df = pd.read_sql_query(text("SELECT * FROM station_raw"), engine, parse_dates=["ts_utc"])
     if df.empty:
@@ -54,21 +68,37 @@ def aggregate_3h():
         "temp_c":"mean", "hum":"mean", "press_hpa":"mean",
         "wind_ms":"mean", "rain_mm":"sum"
     }).reset_index()
-    agg["Time"] = pd.to_datetime(agg["ts_utc"]).dt.tz_localize("UTC").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    agg["Time"] = pd.to_datetime(agg["ts_utc"], utc=True).dt.strftime("%Y-%m-%dT%H:%M:%SZ")
     agg["Wind_kmh"] = agg["wind_ms"] * 3.6
     agg["WindGust_kmh"] = None
     agg = agg[["Time","temp_c","hum","press_hpa","Wind_kmh","WindGust_kmh","rain_mm"]]
     agg.columns = ["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","Rain_mm"]
+    # record convertiti una volta (NaN -> NULL) e una sola executemany, niente Series per riga
+    records = agg.astype(object).where(agg.notna(), None).to_dict("records")
     with engine.begin() as conn:
-        for _, r in agg.iterrows():
-            conn.execute(text("""
-            INSERT INTO station_3h (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, Rain_mm)
-            VALUES (:Time,:Temp_C,:Humidity,:Pressure_hPa,:Wind_kmh,:WindGust_kmh,:Rain_mm)
-            ON CONFLICT(Time) DO UPDATE SET
-              Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
-              Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, Rain_mm=excluded.Rain_mm
-            """), r.to_dict())
-    return len(agg)
+        conn.execute(text("""
+        INSERT INTO station_3h (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, Rain_mm)
+        VALUES (:Time,:Temp_C,:Humidity,:Pressure_hPa,:Wind_kmh,:WindGust_kmh,:Rain_mm)
+        ON CONFLICT(Time) DO UPDATE SET
+          Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
+          Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, Rain_mm=excluded.Rain_mm
+        """), records)
+    return len(records)
+
+def parse_dateutc(value):
+    """Timestamp UTC del report: strptime sul formato Ecowitt, pandas solo per formati diversi."""
+    if value:
+        try:
+            return datetime.strptime(unquote_plus(str(value)), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+        try:
+            ts = pd.to_datetime(value, utc=True)
+            if not pd.isna(ts):
+                return ts.to_pydatetime()
+        except Exception:
+            pass
+    return datetime.now(timezone.utc)
 
 def parse_ecowitt_params(args):
     # Ecowitt "Customized" typically sends GET with many fields; we map the common ones.
@@ -87,10 +117,7 @@ def parse_ecowitt_params(args):
 
     # Time: 'dateutc' like '2025-08-10 14:30:00'
     dateutc = args.get("dateutc") or args.get("time") or args.get("timestamp")
-    try:
-        ts = pd.to_datetime(dateutc, utc=True)
-    except Exception:
-        ts = pd.Timestamp.utcnow().tz_localize("UTC")
+    ts = parse_dateutc(dateutc)
     # Temperature: metric fields often provided as tempc; fallback from tempf
     temp_c = getf("tempc", "temp_c", "outdoor_temp_c", "temp", cast=float)
     if temp_c is None:
@@ -120,7 +147,7 @@ def parse_ecowitt_params(args):
     rain_mm = getf("rainrate", "rainmm", "rain_1h", "rain", cast=float)
 
     return {
-        "ts_utc": ts.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "ts_utc": ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
         "temp_c": temp_c,
         "hum": hum,
         "press_hpa": press_hpa,
@@ -133,8 +160,8 @@ def parse_ecowitt_params(args):
 def report():
     row = parse_ecowitt_params(request.args)
     upsert_raw(row)
-    # Aggregate lazily to keep it simple
-    aggregate_3h()
+    # Ogni report tocca un solo bucket: aggiorno quello, non tutta station_3h
+    aggregate_bucket_3h(row["ts_utc"])
     return jsonify({"status":"ok","stored":row}), 200
 
 if __name__ == "__main__":
@@ -2,8 +2,11 @@ import os
 import pandas as pd
 from sqlalchemy import create_engine
 
+from db import engine_options
+
 DB_URL = os.getenv("DATABASE_URL") or f"sqlite:///{os.getenv('SQLITE_PATH', './data/weather.db')}"
-engine = create_engine(DB_URL)
+# to_sql riscrive tutta station_raw: su psycopg2 executemany in batch VALUES invece di un INSERT per riga
+engine = create_engine(DB_URL, **engine_options(DB_URL))
 
 def fix_pressure(v):
     try:
@@ -0,0 +1,81 @@
+# units.py — conversioni unità Ecowitt (vettoriali, fattori in cache per unità normalizzata)
+import functools
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+@functools.lru_cache(maxsize=64)
+def _norm_unit(u: Optional[str]) -> str:
+    """Unità normalizzata (minuscolo, senza spazi, '' se assente); il vocabolario è piccolo, quindi in cache."""
+    return str(u or "").strip().lower()
+
+# fattori per unità normalizzata: (scala, offset) per la temperatura, moltiplicativi per il resto
+_F_UNITS = frozenset({"f", "°f", "℉", "fahrenheit", "degf"})
+_INCH_UNITS = frozenset({"in", "inch", "inches"})
+_F_AFFINE = (5.0/9.0, -160.0/9.0)  # (v - 32) * 5/9
+_HPA_FACTORS = {"inhg": 33.8638866667, "pa": 0.01, "kpa": 10.0}
+_KMH_FACTORS = {"m/s": 3.6, "mps": 3.6, "ms": 3.6, "mph": 1.60934, "knot": 1.852, "knots": 1.852, "kt": 1.852}
+
+@functools.lru_cache(maxsize=64)
+def _temp_affine(u: str) -> Tuple[float, float]:
+    return _F_AFFINE if u in _F_UNITS else (1.0, 0.0)  # altrimenti assumiamo °C
+
+@functools.lru_cache(maxsize=64)
+def _hpa_factor(u: str) -> float:
+    f = _HPA_FACTORS.get(u)
+    if f is None:
+        if "inhg" in u:
+            f = _HPA_FACTORS["inhg"]
+        elif "kpa" in u:
+            f = _HPA_FACTORS["kpa"]
+    return np.nan if f is None else f  # NaN = unità ignota/hPa, si passa alle correzioni sui valori
+
+@functools.lru_cache(maxsize=64)
+def _kmh_factor(u: str) -> float:
+    f = _KMH_FACTORS.get(u)
+    if f is None:
+        if "m/s" in u:
+            f = 3.6
+        elif "mph" in u:
+            f = 1.60934
+        elif "knot" in u or "kt" in u:
+            f = 1.852
+        else:
+            f = 1.0  # assumiamo km/h
+    return f
+
+def c_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    ab = np.array([_temp_affine(x) for x in u], dtype="float64").reshape(-1, 2)
+    return v * ab[:, 0] + ab[:, 1]
+
+def hpa_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    f = u.map(_hpa_factor).to_numpy(dtype="float64")
+    known = ~np.isnan(f)
+    return np.select(
+        [
+            known,
+            # correzioni da formati scalati
+            (v >= 8000.0) & (v <= 11000.0),
+            v > 2000.0,
+        ],
+        [v * np.where(known, f, 1.0), v / 10.0, v / 100.0],
+        default=v,  # già hPa
+    )
+
+def kmh_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    # fattore per riga dall'unità (in cache), poi una sola moltiplicazione sull'intera colonna
+    return v * u.map(_kmh_factor).to_numpy(dtype="float64")
+
+def mm_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    return np.where(u.isin(_INCH_UNITS).to_numpy(), v * 25.4, v)
+
+def hpa_known_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    """Come hpa_from ma solo per unità note: senza unità il valore resta com'è (già hPa)."""
+    f = u.map(_hpa_factor).to_numpy(dtype="float64")
+    return v * np.where(np.isnan(f), 1.0, f)
+
+def ms_from(v: np.ndarray, u: pd.Series) -> np.ndarray:
+    """Velocità in m/s; senza unità il valore è già m/s."""
+    f = u.map(_kmh_factor).to_numpy(dtype="float64") / 3.6
+    return v * np.where(u.eq("").to_numpy(), 1.0, f)
@@ -6,54 +6,63 @@ weather_ingest.py — Ingest locale (CSV) + forecast OpenWeather
 - Lock cross-platform
 """
 
-import os, sys, glob, time
+import os, sys, glob, functools
 from pathlib import Path
 from typing import Optional
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 from dotenv import load_dotenv
 
+from db import engine_options, enable_sqlite_wal, exec_script, sqlite_checkpoint
+
 # --------------------------- Lock ---------------------------
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 def _lock_path() -> str:
     return os.path.join(os.getenv("TEMP", "."), "ingest.lock") if os.name == "nt" else "/tmp/ingest.lock"
 
 class FileLock:
-    def __init__(self, path: Optional[str] = None, stale_seconds: int = 900):
+    """Lock advisory del kernel (flock su POSIX, msvcrt.locking su Windows), non bloccante.
+
+    Il SO lo rilascia anche se il processo muore: niente lock stantii da riconoscere via timestamp,
+    e nessuna finestra tra "lock scaduto" e ricreazione del file in cui due ingest passano entrambi.
+    """
+    def __init__(self, path: Optional[str] = None):
         self.path = path or _lock_path()
-        self.stale_seconds = int(stale_seconds)
         self._fd = None
     def acquire(self) -> bool:
-        flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
         try:
-            self._fd = os.open(self.path, flags, 0o644)
-            os.write(self._fd, str(int(time.time())).encode("ascii","ignore"))
-            return True
-        except FileExistsError:
-            try:
-                ts = int(Path(self.path).read_text().strip() or "0")
-            except Exception:
-                ts = 0
-            if ts and (time.time() - ts) > self.stale_seconds:
-                try: os.remove(self.path)
-                except Exception: pass
-                try:
-                    self._fd = os.open(self.path, flags, 0o644)
-                    os.write(self._fd, str(int(time.time())).encode("ascii","ignore"))
-                    return True
-                except Exception:
-                    return False
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
             return False
+        self._fd = fd
+        return True
     def release(self):
+        # il file resta: rimuoverlo aprirebbe di nuovo una race con chi l'ha appena aperto
+        if self._fd is None:
+            return
         try:
-            if self._fd is not None:
-                os.close(self._fd)
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
         finally:
-            try:
-                if os.path.exists(self.path):
-                    os.remove(self.path)
-            except Exception:
-                pass
+            os.close(self._fd)
+            self._fd = None
 
 # --------------------------- Config & DB ---------------------------
 load_dotenv()
@@ -62,6 +71,7 @@ def _get_float_env(name: str, default: float) -> float:
     try: return float(os.getenv(name) or default)
     except Exception: return float(default)
 
+@functools.lru_cache(maxsize=8)
 def _normalize_db_url(raw: str) -> str:
     u = (raw or "").strip()
     if not u: return u
@@ -77,24 +87,53 @@ OW_API_KEY = os.getenv("OW_API_KEY", "") or os.getenv("OWM_API_KEY", "") or os.g
 STATION_CSV = os.getenv("STATION_CSV", "").strip()
 STATION_TZ = os.getenv("STATION_TZ", "UTC")
 
+@functools.lru_cache(maxsize=1)
 def engine():
-    if DB_URL: return create_engine(DB_URL, future=True)
+    """Engine unico per processo (un solo pool di connessioni)."""
+    if DB_URL:
+        # psycopg2: executemany tramite execute_batch/execute_values invece di un INSERT per riga
+        return create_engine(DB_URL, future=True, pool_pre_ping=True, **engine_options(DB_URL))
     p = Path(SQLITE_PATH); p.parent.mkdir(parents=True, exist_ok=True)
-    return create_engine(f"sqlite:///{p}", future=True)
+    url = f"sqlite:///{p}"
+    eng = create_engine(url, future=True, **engine_options(url))
+    enable_sqlite_wal(eng)
+    return eng
+
+_SCHEMA_ENSURED: set = set()  # url già inizializzati in questo processo
 
 def ensure_schema(eng):
-    with eng.begin() as con:
-        con.execute(text("""CREATE TABLE IF NOT EXISTS station_raw (
+    if str(eng.url) in _SCHEMA_ENSURED:
+        return
+    # SQLite: tabelle indicizzate direttamente sulla PK Time (niente rowid, una indirezione in meno
+    # nelle scansioni per intervallo). Su Postgres la PK è già un indice btree su Time.
+    suffix = " WITHOUT ROWID" if eng.dialect.name == "sqlite" else ""
+    # un solo script DDL (un round-trip) invece di quattro execute separati
+    ddl = f"""
+        CREATE TABLE IF NOT EXISTS station_raw (
           Time TIMESTAMPTZ PRIMARY KEY,
           Temp_C REAL, Humidity REAL, Pressure_hPa REAL,
           Wind_kmh REAL, WindGust_kmh REAL, WindDir REAL, Rain_mm REAL
-        );"""))
-        con.execute(text("""CREATE TABLE IF NOT EXISTS station_3h (
+        ){suffix};
+        CREATE TABLE IF NOT EXISTS station_3h (
           Time TIMESTAMPTZ PRIMARY KEY,
           Temp_C REAL, Humidity REAL, Pressure_hPa REAL,
           Wind_kmh REAL, WindGust_kmh REAL, Rain_mm REAL
-        );"""))
-        con.execute(text("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)"))
+        ){suffix};
+        CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+    """
+    with eng.begin() as con:
+        exec_script(con, ddl)
+        _ensure_station_3h_unique(con)
+    _SCHEMA_ENSURED.add(str(eng.url))
+
+def _ensure_station_3h_unique(con):
+    """station_3h ricreata in passato da to_sql(replace) non ha PK: serve un indice unico per ON CONFLICT(Time).
+    Con la PK su Time l'indice sarebbe un doppione da aggiornare a ogni upsert: non lo creo (e lo tolgo se c'è)."""
+    pk = inspect(con).get_pk_constraint("station_3h").get("constrained_columns") or []
+    if [c.lower() for c in pk] == ["time"]:
+        con.exec_driver_sql("DROP INDEX IF EXISTS ux_station_3h_time")
+    else:
+        con.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ux_station_3h_time ON station_3h (Time)")
 
 def touch_last_ingest(eng):
     with eng.begin() as con:
@@ -104,25 +143,28 @@ def touch_last_ingest(eng):
         ), {"v": pd.Timestamp.now(tz='UTC').isoformat()})
 
 # --------------------------- Normalizzazioni ---------------------------
-def _fix_pressure(v):
-    if v is None: return None
-    try: x = float(v)
-    except: return None
-    if 800.0 <= x <= 1100.0:  # hPa ok
-        return x
-    if 8000.0 <= x <= 11000.0:  # hPa * 10
-        return x / 10.0
-    if 80000.0 <= x <= 110000.0:  # Pa
-        return x / 100.0
-    if 50.0 <= x <= 200.0:  # kPa
-        return x * 10.0
-    if 20.0 <= x <= 40.0:   # inHg
-        return x * 33.8638866667
+def _fix_pressure(col: pd.Series) -> pd.Series:
+    """Normalizza in hPa un'intera colonna di pressioni (un passaggio NumPy, niente chiamate per riga)."""
+    x = pd.to_numeric(col, errors="coerce").to_numpy(dtype="float64")
+    out = np.select(
+        [
+            (x >= 800.0) & (x <= 1100.0),      # hPa ok
+            (x >= 8000.0) & (x <= 11000.0),    # hPa * 10
+            (x >= 80000.0) & (x <= 110000.0),  # Pa
+            (x >= 50.0) & (x <= 200.0),        # kPa
+            (x >= 20.0) & (x <= 40.0),         # inHg
+        ],
+        [x, x / 10.0, x / 100.0, x * 10.0, x * 33.8638866667],
+        default=np.nan,
+    )
     # fallback: porta nel range plausibile
+    rest = np.isnan(out) & ~np.isnan(x)
+    y = x[rest]
     for _ in range(3):
-        if 800.0 <= x <= 1100.0: break
-        x = x/10.0 if x>1100.0 else x*10.0
-    return x
+        bad = (y < 800.0) | (y > 1100.0)
+        y = np.where(bad, np.where(y > 1100.0, y / 10.0, y * 10.0), y)
+    out[rest] = y
+    return pd.Series(out, index=col.index)
 
 # --------------------------- CSV → station_raw ---------------------------
 def _pick_time_col(df: pd.DataFrame) -> str:
@@ -132,6 +174,7 @@ def _pick_time_col(df: pd.DataFrame) -> str:
     return df.columns[0]
 
 def read_station_from_csv(csv_path: str) -> pd.DataFrame:
+    """CSV stazione normalizzato; Time esce sempre come datetime64[ns, UTC] (upsert_raw non lo riconverte)."""
     files = []
     if any(ch in csv_path for ch in ["*", "?", "["]): files = sorted(glob.glob(csv_path))
     elif Path(csv_path).exists(): files = [csv_path]
@@ -174,7 +217,7 @@ def read_station_from_csv(csv_path: str) -> pd.DataFrame:
 
     # normalizza pressione
     if "Pressure_hPa" in df.columns:
-        df["Pressure_hPa"] = df["Pressure_hPa"].map(_fix_pressure)
+        df["Pressure_hPa"] = _fix_pressure(df["Pressure_hPa"])
 
     keep = [c for c in ["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","WindDir","Rain_mm"] if c in df.columns]
     return df[keep].dropna(subset=["Time"]).sort_values("Time")
@@ -202,42 +245,100 @@ def fetch_openweather_forecast(lat: float, lon: float, api_key: str) -> pd.DataF
     return pd.DataFrame(rows)
 
 # --------------------------- DB writes ---------------------------
+_RAW_COLS = ["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","WindDir","Rain_mm"]
+
+def _chunked(records, chunk_size: int = 5000):
+    for i in range(0, len(records), chunk_size):
+        yield records[i:i+chunk_size]
+
 def upsert_raw(df: pd.DataFrame, eng):
     if df is None or df.empty: return 0
-    df = df.copy(); df["Time"] = pd.to_datetime(df["Time"], utc=True)
+    if list(df.columns) != _RAW_COLS:
+        df = df.reindex(columns=_RAW_COLS)
+    t = df["Time"]
+    # read_station_from_csv consegna gia' datetime64 UTC: riconverto solo input di altro tipo
+    if t.dtype.kind != "M":
+        t = pd.to_datetime(t, utc=True)
+    elif t.dt.tz is None:
+        t = t.dt.tz_localize("UTC")
+    elif str(t.dt.tz) != "UTC":
+        t = t.dt.tz_convert("UTC")
+    # ndarray di datetime (sqlite3 non adatta i Timestamp), senza il FutureWarning di Series.dt.to_pydatetime
+    times = t.array.to_pydatetime()
+    df = df.astype(object).where(df.notna(), None)
+    df["Time"] = pd.Series(times, index=df.index, dtype=object)
+    records = df.to_dict("records")
+    stmt = text("""
+        INSERT INTO station_raw (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, WindDir, Rain_mm)
+        VALUES (:Time, :Temp_C, :Humidity, :Pressure_hPa, :Wind_kmh, :WindGust_kmh, :WindDir, :Rain_mm)
+        ON CONFLICT (Time) DO UPDATE SET
+          Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
+          Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, WindDir=excluded.WindDir, Rain_mm=excluded.Rain_mm;
+    """)
+    # un executemany per chunk invece di un round-trip per riga
     with eng.begin() as con:
-        for _, row in df.iterrows():
-            con.execute(text("""
-                INSERT INTO station_raw (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, WindDir, Rain_mm)
-                VALUES (:Time, :Temp_C, :Humidity, :Pressure_hPa, :Wind_kmh, :WindGust_kmh, :WindDir, :Rain_mm)
-                ON CONFLICT (Time) DO UPDATE SET
-                  Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
-                  Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, WindDir=excluded.WindDir, Rain_mm=excluded.Rain_mm;
-            """), {k:(row.get(k).item() if hasattr(row.get(k),'item') else row.get(k)) for k in ["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","WindDir","Rain_mm"]})
-    return len(df)
-
-def recompute_station_3h(eng, lookback_hours: int = 96):
+        for chunk in _chunked(records, chunk_size=5000):
+            con.execute(stmt, chunk)
+    return len(records)
+
+# inizio del bucket 3h (UTC) per dialetto; su SQLite nello stesso formato testo dei datetime scritti
+_BUCKET_3H_SQL = {
+    "postgresql": "to_timestamp(floor(extract(epoch from CAST(Time AS timestamptz)) / 10800) * 10800)",
+    "sqlite": "datetime((CAST(strftime('%s', Time) AS INTEGER) / 10800) * 10800, 'unixepoch') || '+00:00'",
+}
+
+def recompute_station_3h(eng, lookback_hours: int = 96, since=None):
+    """Aggiorna station_3h in modo incrementale: solo i bucket dall'ultimo già calcolato in poi
+    (o da `since`, se i dati raw appena scritti sono più vecchi, comunque entro lookback_hours).
+
+    Senza `since` (nessuna riga raw scritta dal chiamante) non fa nulla se il raw più recente
+    cade ancora nell'ultimo bucket già costruito."""
     with eng.begin() as con:
-        df = pd.read_sql(
-            text("SELECT * FROM station_raw WHERE Time >= :t0 ORDER BY Time"),
-            con, params={"t0": (pd.Timestamp.utcnow() - pd.Timedelta(hours=lookback_hours)).isoformat()}
-        )
-    if df.empty: return 0
-    df["Time"] = pd.to_datetime(df["Time"], utc=True)
-    st3h = (df.set_index("Time")
-              .resample("3H")
-              .agg({"Temp_C":"mean","Humidity":"mean","Pressure_hPa":"mean",
-                    "Wind_kmh":"mean","WindGust_kmh":"max","Rain_mm":"sum"})
-              .reset_index())
+        last3h, last_raw = con.execute(text(
+            "SELECT (SELECT MAX(Time) FROM station_3h), (SELECT MAX(Time) FROM station_raw)"
+        )).one()
+    t_min = pd.Timestamp.now(tz="UTC") - pd.Timedelta(hours=lookback_hours)
+    t0 = t_min
+    if last3h is not None:
+        last3h = pd.to_datetime(last3h, utc=True, errors="coerce")
+        if not pd.isna(last3h):
+            if since is None:
+                last_raw = pd.to_datetime(last_raw, utc=True, errors="coerce") if last_raw is not None else None
+                if last_raw is None or pd.isna(last_raw) or last_raw < last3h + pd.Timedelta(hours=3):
+                    return 0
+            # l'ultimo bucket può essere ancora aperto: riparto da un bucket prima
+            t0 = last3h - pd.Timedelta(hours=3)
+    if since is not None:
+        since = pd.to_datetime(since, utc=True, errors="coerce")
+        if not pd.isna(since):
+            t0 = min(t0, max(since, t_min).floor("3h"))
+    # aggregazione interamente nel DB: nessun round-trip dei dati raw in Python.
+    # t0 come stringa ISO (separatore spazio, come i datetime salvati da sqlite3): Postgres la converte
+    # da sola se Time è TIMESTAMPTZ e la confronta come testo se Time è TEXT (schema.sql)
+    bucket = _BUCKET_3H_SQL[eng.dialect.name]
     with eng.begin() as con:
-        st3h.to_sql("station_3h", con.connection, if_exists="replace", index=False)
-    return len(st3h)
+        res = con.execute(text(f"""
+            INSERT INTO station_3h (Time, Temp_C, Humidity, Pressure_hPa, Wind_kmh, WindGust_kmh, Rain_mm)
+            SELECT {bucket} AS bucket,
+                   AVG(Temp_C), AVG(Humidity), AVG(Pressure_hPa), AVG(Wind_kmh), MAX(WindGust_kmh), COALESCE(SUM(Rain_mm), 0)
+            FROM station_raw
+            WHERE Time >= :t0
+            GROUP BY bucket
+            ON CONFLICT (Time) DO UPDATE SET
+              Temp_C=excluded.Temp_C, Humidity=excluded.Humidity, Pressure_hPa=excluded.Pressure_hPa,
+              Wind_kmh=excluded.Wind_kmh, WindGust_kmh=excluded.WindGust_kmh, Rain_mm=excluded.Rain_mm;
+        """), {"t0": t0.isoformat(sep=" ")})
+    return max(res.rowcount, 0)
 
 def upsert_table(df: pd.DataFrame, table: str, eng):
+    """Sostituisce `table` con df senza finestre vuote: scrive in {table}_new e fa lo swap in una transazione."""
     if df is None or df.empty: return
+    tmp = f"{table}_new"
     with eng.begin() as con:
-        con.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {table} (dummy TEXT)")
-    df.to_sql(table, eng, if_exists="replace", index=False)
+        # chunksize * colonne resta sotto il limite di 999 parametri delle SQLite più vecchie
+        df.to_sql(tmp, con, if_exists="replace", index=False, method="multi", chunksize=100)
+        con.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+        con.exec_driver_sql(f"ALTER TABLE {tmp} RENAME TO {table}")
 
 # --------------------------- main ---------------------------
 def main():
@@ -255,7 +356,7 @@ def main():
             raw = read_station_from_csv(STATION_CSV)
             if not raw.empty:
                 n = upsert_raw(raw, eng)
-                n3 = recompute_station_3h(eng, lookback_hours=96)
+                n3 = recompute_station_3h(eng, lookback_hours=96, since=raw["Time"].min())
                 print(f"Stazione: upsert {n} raw, {n3} bucket 3h")
 
         # FORECAST OWM
@@ -265,6 +366,7 @@ def main():
 
         # META
         touch_last_ingest(eng)
+        sqlite_checkpoint(eng)
         print("Ingest completato.")
     finally:
         lock.release()
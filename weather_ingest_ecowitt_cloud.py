@@ -8,18 +8,32 @@ Compatibile con schema minuscolo:
 """
 
 import os
+import re
 import sys
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+import numpy as np
 import pandas as pd
+from requests.adapters import HTTPAdapter
 from sqlalchemy import text
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
-from db import get_engine as _get_engine, ensure_schema as _ensure_schema
+from db import get_engine as _get_engine, ensure_schema as _ensure_schema, copy_upsert, sqlite_checkpoint
+from units import _norm_unit, c_from, hpa_from, kmh_from, mm_from
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except Exception:
+    import json
+    _json_loads = json.loads
 
 # -------------------- Setup & log --------------------
 load_dotenv()
@@ -36,117 +50,160 @@ APP_KEY = (os.getenv("ECOWITT_APP_KEY") or os.getenv("ECOWITT_APPLICATION_KEY")
 API_KEY = (os.getenv("ECOWITT_API_KEY") or "").strip()
 MAC     = (os.getenv("ECOWITT_MAC") or "").strip().replace("-",":").lower()
 BACKFILL_HOURS = int((os.getenv("BACKFILL_HOURS") or "0").strip() or "0")
+HISTORY_WORKERS = 4  # richieste history concorrenti (margine sul rate-limit Ecowitt)
+COPY_MIN_ROWS = 2000  # da questa soglia su Postgres si usa COPY invece di executemany
 
 # -------------------- DB helpers --------------------
+@functools.lru_cache(maxsize=1)
 def engine():
-    """Ritorna l'Engine SQLAlchemy centralizzato (db.py)."""
-    return _get_engine()
+    """Ritorna l'Engine SQLAlchemy centralizzato (db.py), risolto una volta per processo; WAL su SQLite (writer)."""
+    return _get_engine(wal=True)
 
 
 def ensure_schema():
     """Crea le tabelle se mancanti usando schema.sql (db.py)."""
-    _ensure_schema()
+    _ensure_schema(engine())
 
 # -------------------- Ecowitt API --------------------
+# Sessione condivisa: keep-alive + gzip, evita un handshake TLS per ogni giorno di backfill
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept-Encoding": "gzip"})
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1, pool_maxsize=HISTORY_WORKERS,
+        # 429/5xx transitori: ritenta con backoff invece di perdere il giorno di backfill
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset({"GET"})),
+    ),
+)
+
 def ecowitt_get(path: str, params: Dict[str, Any]) -> Dict[str, Any]:
     url = f"https://api.ecowitt.net/api/v3/{path}"
     p = {"application_key": APP_KEY, "api_key": API_KEY, **params}
-    r = requests.get(url, params=p, timeout=25)
+    r = _SESSION.get(url, params=p, timeout=(5, 25))  # (connect, read)
     r.raise_for_status()
-    return r.json()
+    return _json_loads(r.content)
+
+_DAY_LAST_SECOND = pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+
+def _fetch_history_day(rng):
+    """Scarica e parsa la history di un giorno; ritorna (DataFrame, errore) senza sollevare (uso nel thread pool).
+
+    Il parsing nel worker si sovrappone alle richieste ancora in volo per gli altri giorni.
+    """
+    day, end = rng
+    try:
+        hist = ecowitt_get(
+            "device/history",
+            {
+                "mac": MAC,
+                "start_date": day.strftime("%Y-%m-%d 00:00:00"),
+                "end_date": end.strftime("%Y-%m-%d %H:%M:%S"),
+                "call_back": "outdoor,wind,pressure,rainfall",
+            },
+        )
+        return parse_payload(hist), None
+    except Exception as e:
+        return None, e
 
 # -------------------- Parsing utils --------------------
+_NUM_RE = re.compile(r"^-?\d+(?:\.\d+)?$")
+_STRIP_WS = str.maketrans("", "", " \t\u00a0")  # spazi, tab e NBSP (separatore migliaia)
+
 def safe_float(val: Any) -> Optional[float]:
-    """Float robusto con virgola, None e stringhe strane."""
+    """Float robusto con virgola, None e stringhe strane.
+
+    >>> safe_float("21,4"), safe_float("1.234,5"), safe_float("1,234.5")
+    (21.4, 1234.5, 1234.5)
+    >>> safe_float("1,234,567"), safe_float("1.234.567"), safe_float("n/d")
+    (1234567.0, 1234567.0, None)
+    """
     if val is None:
         return None
     if isinstance(val, (int, float)):
         return float(val)
-    s = str(val).strip()
+    s = val.strip() if isinstance(val, str) else str(val).strip()
     if not s:
         return None
-    s = s.replace(" ", "")
-    # Gestione separatori EU
-    if "." in s and "," in s and s.rfind(",") > s.rfind("."):
-        s = s.replace(".", "").replace(",", ".")
-    else:
-        if "," in s and "." not in s:
-            s = s.replace(",", ".")
-        if s.count(",") > 1 and "." in s:
+    # caso comune (es. "21.4", "-3"): niente pulizia separatori; float() diretto anche per
+    # gli interi, in CPython float(int(s)) è più lento di float(s)
+    if _NUM_RE.match(s):
+        return float(s)
+    s = s.translate(_STRIP_WS)
+    # Gestione separatori EU: decide l'ultimo separatore, al più due replace
+    last_dot, last_com = s.rfind("."), s.rfind(",")
+    if last_com > last_dot:
+        if last_dot < 0 and s.count(",") > 1:   # virgole delle migliaia: "1,234,567"
             s = s.replace(",", "")
-        if s.count(".") > 1 and "," not in s:
-            s = s.replace(".", "")
+        else:                                   # virgola decimale: "1.234,5", "12,5"
+            s = s.replace(".", "").replace(",", ".")
+    elif last_com >= 0:           # virgola delle migliaia: "1,234.5"
+        s = s.replace(",", "")
+    elif s.count(".") > 1:        # punti delle migliaia: "1.234.567"
+        s = s.replace(".", "")
     try:
         return float(s)
     except Exception:
         return None
 
-def first(d: Any, keys: List[str]) -> Any:
+_MISSING = object()
+
+def first(d: Any, keys: Tuple[str, ...]) -> Any:
     """Ritorna il primo campo presente tra keys in un dict (o None)."""
     if not isinstance(d, dict):
         return None
-    for k in keys:
+    # caso comune: c'è la prima chiave, una sola lookup
+    v = d.get(keys[0], _MISSING)
+    if v is not _MISSING:
+        return v
+    for k in keys[1:]:
         if k in d:
             return d[k]
     return None
 
+# alias dei campi Ecowitt (tuple a livello modulo, non liste ricostruite a ogni item)
+_K_VALUE = ("value", "val", "v")
+_K_UNIT  = ("unit", "u")
+_K_TIME  = ("time", "last_update_time", "update_time", "date", "timestamp")
+_K_TEMP  = ("temperature", "temp_c", "temp")
+_K_HUM   = ("humidity", "hum")
+_K_PRESS = ("rel", "relative", "relative_hpa", "rel_hpa", "abs_hpa", "abs")
+_K_WSPD  = ("speed", "avg", "windspeed", "avg_mps", "speed_mps", "ws", "wspd")
+_K_GUST  = ("gust", "max", "gust_mps", "gust_ms")
+_K_WDIR  = ("direction", "dir_deg", "dir", "wdir")
+_K_RAIN  = ("rate", "rain_rate", "rainrate_mm", "rainrate", "rainrate_in", "rain_last_10min", "rain_last_1h")
+
 def val_and_unit(node: Any) -> (Optional[float], Optional[str]):
     """Accetta sia {value,unit} sia float grezzo."""
     if isinstance(node, dict):
-        v = first(node, ["value","val","v"])
-        u = first(node, ["unit","u"])
+        v = first(node, _K_VALUE)
+        u = first(node, _K_UNIT)
         return safe_float(v), (u or None)
     return safe_float(node), None
 
-def c_from(val: Optional[float], unit: Optional[str]) -> Optional[float]:
-    if val is None:
-        return None
-    u = (unit or "").lower()
-    v = float(val)
-    if u in ("f","°f","fahrenheit","degf"):
-        return (v - 32.0) * 5.0/9.0
-    return v  # assumiamo °C
+# -------------------- Conversioni unità (vettoriali) --------------------
+# fattori in cache e conversioni in units.py, condivisi con ecowitt_api.history_to_df
+def _units(df: pd.DataFrame, col: str) -> pd.Series:
+    """Colonna unità normalizzata."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].map(_norm_unit)
 
-def hpa_from(val: Optional[float], unit: Optional[str]) -> Optional[float]:
-    if val is None:
-        return None
-    u = (unit or "").lower()
-    v = float(val)
-    # conversioni comuni
-    if "inhg" in u:
-        return v * 33.8638866667
-    if u == "pa":
-        return v / 100.0
-    if "kpa" in u:
-        return v * 10.0
-    # correzioni da formati scalati
-    if 8000.0 <= v <= 11000.0:
-        return v / 10.0
-    if v > 2000.0:
-        return v / 100.0
-    return v  # già hPa
-
-def kmh_from(val: Optional[float], unit: Optional[str]) -> Optional[float]:
-    if val is None:
-        return None
-    u = (unit or "").lower()
-    v = float(val)
-    if "m/s" in u or u == "mps" or u == "ms":
-        return v * 3.6
-    if "mph" in u:
-        return v * 1.60934
-    if "knot" in u or "kt" in u:
-        return v * 1.852
-    return v  # assumiamo km/h
+def _values(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        return np.full(len(df), np.nan)
+    return df[col].to_numpy(dtype="float64", na_value=np.nan)
 
 # -------------------- Parsing payload --------------------
-def parse_item(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    # timestamp
-    t_raw = first(item, ["time","last_update_time","update_time","date","timestamp"])
-    try:
-        ts = pd.to_datetime(t_raw, utc=True).to_pydatetime()
-    except Exception:
-        ts = datetime.now(timezone.utc)
+# colonne grezze prodotte da parse_item (stesso ordine della tupla ritornata)
+_VALUE_COLS = ("t_v", "humidity", "p_v", "w_v", "g_v", "winddir", "r_v")
+_UNIT_COLS  = ("t_u", "p_u", "w_u", "g_u", "r_u")
+
+def parse_item(item: Dict[str, Any]) -> Optional[Tuple[Any, tuple, tuple]]:
+    """Ritorna (time grezzo, valori grezzi in ordine _VALUE_COLS, unità in ordine _UNIT_COLS)."""
+    # timestamp: convertito una sola volta per colonna in parse_payload
+    t_raw = first(item, _K_TIME)
 
     out  = item.get("outdoor", {}) or {}
     wnd  = item.get("wind", {}) or {}
@@ -154,191 +211,281 @@ def parse_item(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     rain = item.get("rainfall", {}) or {}
 
     # temperatura/umidità
-    t_v, t_u = val_and_unit(first(out, ["temperature","temp_c","temp"]))
-    h_v, _   = val_and_unit(first(out, ["humidity","hum"]))
-    temp_c   = c_from(t_v, t_u)
+    t_v, t_u = val_and_unit(first(out, _K_TEMP))
+    h_v, _   = val_and_unit(first(out, _K_HUM))
 
     # pressione
-    pnode = first(prs, ["rel","relative","relative_hpa","rel_hpa","abs_hpa","abs"])
+    pnode = first(prs, _K_PRESS)
     p_v, p_u = val_and_unit(pnode)
-    p_hpa = hpa_from(p_v, p_u)
 
     # vento
     wspd_node = (
-        first(wnd, ["speed","avg","windspeed","avg_mps","speed_mps","ws","wspd"])
+        first(wnd, _K_WSPD)
         or wnd.get("wind_speed") or wnd.get("speed_kmh") or wnd.get("wspeed")
     )
     gust_node = (
-        first(wnd, ["gust","max","gust_mps","gust_ms"])
+        first(wnd, _K_GUST)
         or wnd.get("wind_gust") or wnd.get("gust_kmh")
     )
-    wdir_node = first(wnd, ["direction","dir_deg","dir","wdir"])
+    wdir_node = first(wnd, _K_WDIR)
 
     w_v, w_u = val_and_unit(wspd_node)
     g_v, g_u = val_and_unit(gust_node)
     d_v, _   = val_and_unit(wdir_node)
 
-    wind_kmh  = kmh_from(w_v, w_u)
-    gust_kmh  = kmh_from(g_v, g_u)
-
     # pioggia (tasso o aggregato breve)
-    rnode = first(rain, ["rate","rain_rate","rainrate_mm","rainrate","rainrate_in","rain_last_10min","rain_last_1h"])
+    rnode = first(rain, _K_RAIN)
     r_v, r_u = val_and_unit(rnode)
-    if r_u and r_u.lower() in ("in","inch","inches"):
-        rain_mm = r_v * 25.4 if r_v is not None else None
-    else:
-        rain_mm = r_v
-
-    return {
-        "time": pd.Timestamp(ts).tz_convert("UTC").isoformat(),
-        "temp_c": temp_c,
-        "humidity": safe_float(h_v),
-        "pressure_hpa": p_hpa,
-        "wind_kmh": wind_kmh,
-        "windgust_kmh": gust_kmh,
-        "winddir": safe_float(d_v),
-        "rain_mm": safe_float(rain_mm),
-    }
+
+    # valori grezzi + unità: la conversione avviene per colonna in parse_payload
+    return (
+        t_raw,
+        (t_v, h_v, p_v, w_v, g_v, d_v, r_v),
+        (t_u, p_u, w_u, g_u, r_u),
+    )
 
 def parse_payload(j: Dict[str, Any]) -> pd.DataFrame:
     data = j.get("data") if isinstance(j, dict) else None
     if not data:
         return pd.DataFrame()
     items = data.get("list") if isinstance(data.get("list"), list) and data.get("list") else [data]
-    rows: List[Dict[str, Any]] = []
+    # buffer colonnari preallocati (niente lista di dict da ricopiare nel DataFrame)
+    n = len(items)
+    times = np.empty(n, dtype=object)
+    values = np.full((n, len(_VALUE_COLS)), np.nan)
+    units = np.empty((n, len(_UNIT_COLS)), dtype=object)
+    k = 0
     for it in items:
         try:
             rec = parse_item(it)
             if rec:
-                rows.append(rec)
+                times[k] = rec[0]
+                values[k] = [np.nan if v is None else v for v in rec[1]]
+                units[k] = rec[2]
+                k += 1
         except Exception as e:
             if LOG_LEVEL == "DEBUG":
                 log.debug("skip item: %s", e)
-    if not rows:
+    if not k:
         return pd.DataFrame()
-    df = pd.DataFrame(rows).drop_duplicates(subset=["time"]).sort_values("time")
-    return df
+    df = pd.DataFrame(values[:k], columns=list(_VALUE_COLS))
+    df[list(_UNIT_COLS)] = units[:k]
+    # una sola conversione vettoriale; i timestamp illeggibili diventano "adesso" come prima
+    ts = pd.to_datetime(pd.Series(times[:k]), utc=True, errors="coerce", format="mixed")
+    df.insert(0, "time", ts.fillna(pd.Timestamp.now(tz="UTC")).dt.strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+    df = df.drop_duplicates(subset=["time"]).sort_values("time")
+    return convert_units(df)
+
+def convert_units(df: pd.DataFrame) -> pd.DataFrame:
+    """Converte in un solo passaggio vettoriale le colonne grezze (valore, unità) in °C/hPa/km/h/mm."""
+    out = pd.DataFrame({"time": df["time"].to_numpy()}, index=df.index)
+    out["temp_c"]       = c_from(_values(df, "t_v"), _units(df, "t_u"))
+    out["humidity"]     = _values(df, "humidity")
+    out["pressure_hpa"] = hpa_from(_values(df, "p_v"), _units(df, "p_u"))
+    out["wind_kmh"]     = kmh_from(_values(df, "w_v"), _units(df, "w_u"))
+    out["windgust_kmh"] = kmh_from(_values(df, "g_v"), _units(df, "g_u"))
+    out["winddir"]      = _values(df, "winddir")
+    out["rain_mm"]      = mm_from(_values(df, "r_v"), _units(df, "r_u"))
+    return out
 
 # -------------------- Upsert & aggregazione --------------------
-def _chunked(records: List[Dict[str, Any]], chunk_size: int = 5000):
+# statement costruiti una volta a import, non a ogni chiamata
+_EXISTING_TIMES_STMT = text("SELECT time FROM station_raw WHERE time >= :t0 AND time <= :t1")
+
+_RAW_COLS = ("time", "temp_c", "humidity", "pressure_hpa", "wind_kmh", "windgust_kmh", "winddir", "rain_mm")
+
+@functools.lru_cache(maxsize=4)
+def _upsert_raw_sql(paramstyle: str) -> str:
+    """Upsert station_raw a parametri posizionali (righe come tuple, non dict) nello stile del driver."""
+    ph = ", ".join(["?" if paramstyle == "qmark" else "%s"] * len(_RAW_COLS))
+    updates = ", ".join(f"{c}=excluded.{c}" for c in _RAW_COLS[1:])
+    return (
+        f"INSERT INTO station_raw ({', '.join(_RAW_COLS)}) VALUES ({ph}) "
+        f"ON CONFLICT (time) DO UPDATE SET {updates}"
+    )
+
+_UPSERT_3H_STMT = text("""
+    INSERT INTO station_3h (time, temp_c, humidity, pressure_hpa, wind_kmh, windgust_kmh, rain_mm)
+    VALUES (:time, :temp_c, :humidity, :pressure_hpa, :wind_kmh, :windgust_kmh, :rain_mm)
+    ON CONFLICT (time) DO UPDATE SET
+      temp_c=excluded.temp_c,
+      humidity=excluded.humidity,
+      pressure_hpa=excluded.pressure_hpa,
+      wind_kmh=excluded.wind_kmh,
+      windgust_kmh=excluded.windgust_kmh,
+      rain_mm=excluded.rain_mm;
+""")
+
+_TOUCH_STMT = text("""
+    INSERT INTO meta (k, v) VALUES ('last_ingest', :v)
+    ON CONFLICT (k) DO UPDATE SET v=excluded.v
+""")
+
+def _chunked(records: List[Any], chunk_size: int = 1000):
     for i in range(0, len(records), chunk_size):
         yield records[i:i+chunk_size]
 
-def upsert_raw(df: pd.DataFrame) -> int:
-    """Upsert bulk (executemany) su station_raw."""
+def _existing_times(con, t0: str, t1: str) -> set:
+    """Timestamp già presenti in station_raw nell'intervallo [t0, t1], come stringhe ISO '...Z'.
+
+    La colonna può essere TEXT (schema.sql) o TIMESTAMPTZ (weather_ingest.py): i datetime
+    vengono riportati allo stesso formato delle stringhe scritte da upsert_raw.
+    """
+    vals = con.execute(_EXISTING_TIMES_STMT, {"t0": t0, "t1": t1}).scalars().all()
+    if vals and not isinstance(vals[0], str):
+        return set(pd.to_datetime(vals, utc=True).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    return set(vals)
+
+def upsert_raw(con, df: pd.DataFrame) -> Tuple[int, Optional[str]]:
+    """Upsert bulk (executemany) su station_raw delle sole righe nuove, nella transazione di `con`.
+
+    Ritorna (righe scritte, timestamp minimo scritto o None): il minimo delimita il ricalcolo 3h.
+    """
     if df is None or df.empty:
-        return 0
-    keep = ["time","temp_c","humidity","pressure_hpa","wind_kmh","windgust_kmh","winddir","rain_mm"]
-    df = df[keep].copy()
+        return 0, None
+    df = df[list(_RAW_COLS)].copy()
     # normalizza timestamp in ISO UTC (string) per compatibilità sqlite/postgres
     df["time"] = pd.to_datetime(df["time"], utc=True, errors="coerce").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
     df = df.dropna(subset=["time"])
-    records = df.to_dict("records")
-    if not records:
-        return 0
+    if df.empty:
+        return 0, None
 
-    stmt = text("""
-        INSERT INTO station_raw (time, temp_c, humidity, pressure_hpa, wind_kmh, windgust_kmh, winddir, rain_mm)
-        VALUES (:time, :temp_c, :humidity, :pressure_hpa, :wind_kmh, :windgust_kmh, :winddir, :rain_mm)
-        ON CONFLICT (time) DO UPDATE SET
-          temp_c=excluded.temp_c,
-          humidity=excluded.humidity,
-          pressure_hpa=excluded.pressure_hpa,
-          wind_kmh=excluded.wind_kmh,
-          windgust_kmh=excluded.windgust_kmh,
-          winddir=excluded.winddir,
-          rain_mm=excluded.rain_mm;
-    """)
-    with engine().begin() as con:
-        for chunk in _chunked(records, chunk_size=5000):
-            con.execute(stmt, chunk)
-    return len(records)
+    # salta i timestamp già scritti (rerun/backfill sovrapposti): niente riscritture inutili
+    existing = _existing_times(con, df["time"].min(), df["time"].max())
+    if existing:
+        df = df[~df["time"].isin(existing)]
+    if df.empty:
+        return 0, None
+    tmin = df["time"].min()
+    if con.dialect.name == "postgresql" and len(df) >= COPY_MIN_ROWS:
+        # backfill grande: COPY salta parser/planner per ogni riga
+        return copy_upsert(con, df, "station_raw"), tmin
+    # SQLite/batch piccoli: executemany in un'unica transazione (WAL) resta più veloce
+    # di to_sql(method="multi") su tabella di staging + merge
+    # NaN -> NULL (Postgres salverebbe 'NaN' nelle colonne REAL)
+    # tuple posizionali via exec_driver_sql: niente dict per riga né binding per nome
+    clean = df.astype(object).where(df.notna(), None)
+    records = list(clean.itertuples(index=False, name=None))
+    sql = _upsert_raw_sql(con.dialect.paramstyle)
+    for chunk in _chunked(records, chunk_size=1000):
+        con.exec_driver_sql(sql, chunk)
+    return len(records), tmin
+
+# colonne di station_3h e relativa aggregazione (condivise tra percorso pandas e SQL)
+_AGG_3H = {
+    "temp_c": "mean",
+    "humidity": "mean",
+    "pressure_hpa": "mean",
+    "wind_kmh": "mean",
+    "windgust_kmh": "max",
+    "rain_mm": "sum",
+}
+
+# solo le colonne aggregate, niente SELECT *; alias espliciti perché SQLite
+# riporta il nome dichiarato nello schema (Time, Temp_C, ...)
+_READ_RAW_3H_STMT = text(
+    "SELECT " + ", ".join(f"{c} AS {c}" for c in ("time", *_AGG_3H))
+    + " FROM station_raw WHERE time >= :t0 ORDER BY time"
+)
 
-def recompute_3h(window_start_utc: Optional[pd.Timestamp] = None, lookback_hours: int = 96) -> int:
+_TIME_TYPE_STMT = text("""
+    SELECT data_type FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = :t AND column_name = 'time'
+""")
+_PG_TIME_TYPES: Dict[str, str] = {}
+
+def _pg_time_type(con, table: str) -> str:
+    """Tipo della colonna time di `table` su Postgres ('text' da schema.sql, timestamptz da weather_ingest.py)."""
+    key = f"{con.engine.url}|{table}"
+    if key not in _PG_TIME_TYPES:
+        _PG_TIME_TYPES[key] = (con.execute(_TIME_TYPE_STMT, {"t": table}).scalar() or "text").lower()
+    return _PG_TIME_TYPES[key]
+
+_BUCKET_3H_PG = "to_timestamp(floor(extract(epoch FROM CAST(time AS timestamptz)) / 10800) * 10800)"
+
+@functools.lru_cache(maxsize=2)
+def _recompute_3h_pg(typed_time: bool):
+    """INSERT ... SELECT ... GROUP BY su station_3h: bucket timestamptz se la colonna è un timestamp,
+    altrimenti stringa ISO '...Z' come quelle scritte dal percorso pandas."""
+    bucket = _BUCKET_3H_PG if typed_time else (
+        f"""to_char({_BUCKET_3H_PG} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"')""")
+    return text(f"""
+    INSERT INTO station_3h (time, temp_c, humidity, pressure_hpa, wind_kmh, windgust_kmh, rain_mm)
+    SELECT
+      {bucket} AS bucket,
+      AVG(temp_c), AVG(humidity), AVG(pressure_hpa), AVG(wind_kmh), MAX(windgust_kmh), COALESCE(SUM(rain_mm), 0)
+    FROM station_raw
+    WHERE time >= :t0
+    GROUP BY bucket
+    ON CONFLICT (time) DO UPDATE SET
+      temp_c=excluded.temp_c,
+      humidity=excluded.humidity,
+      pressure_hpa=excluded.pressure_hpa,
+      wind_kmh=excluded.wind_kmh,
+      windgust_kmh=excluded.windgust_kmh,
+      rain_mm=excluded.rain_mm
+""")
+
+_MAX_3H_STMT = text("SELECT MAX(time) FROM station_3h")
+_MAX_RAW_STMT = text("SELECT MAX(time) FROM station_raw")
+
+def _max_time(con, stmt) -> Optional[pd.Timestamp]:
+    """MAX(time) di una tabella come Timestamp UTC (None se vuota o non parsabile); TEXT o TIMESTAMPTZ."""
+    v = con.execute(stmt).scalar()
+    t = pd.to_datetime(v, utc=True, errors="coerce") if v is not None else None
+    return None if t is None or pd.isna(t) else t
+
+def recompute_3h(con, window_start_utc: Optional[pd.Timestamp] = None, lookback_hours: int = 96) -> int:
     """Ricalcolo 3h *incrementale* (upsert solo dei bucket toccati).
 
     - Se window_start_utc è None: usa now-lookback_hours.
+    - Non parte mai dopo l'ultimo bucket già in station_3h (entro lookback_hours): se un ricalcolo
+      precedente è fallito, le righe raw già scritte (poi saltate come esistenti) rientrano nella finestra.
     - Legge station_raw nell'intervallo [t0, now] e upserta station_3h.
+    - Su Postgres l'aggregazione è un unico INSERT ... SELECT ... GROUP BY nel DB.
     """
-    now = pd.Timestamp.utcnow().tz_localize("UTC")
+    now = pd.Timestamp.now(tz="UTC")
     if window_start_utc is None:
         t0 = now - pd.Timedelta(hours=lookback_hours)
     else:
         t0 = pd.to_datetime(window_start_utc, utc=True, errors="coerce")
         if pd.isna(t0):
             t0 = now - pd.Timedelta(hours=lookback_hours)
-
-    with engine().begin() as con:
-        df = pd.read_sql(
-            text("SELECT * FROM station_raw WHERE time >= :t0 ORDER BY time"),
-            con,
-            params={"t0": t0.strftime("%Y-%m-%dT%H:%M:%SZ")}
-        )
+    t_min = now - pd.Timedelta(hours=lookback_hours)
+    last3h = _max_time(con, _MAX_3H_STMT)
+    t0 = min(t0, t_min if last3h is None else max(last3h, t_min))
+    # allineo t0 al bordo 3H *prima* di leggere: il primo bucket va ricalcolato con tutte le sue righe
+    t0 = t0.floor("3h")
+    t0_s = t0.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    if con.dialect.name == "postgresql":
+        # aggregazione nel DB: tornano solo le righe dei bucket, non i minuti grezzi
+        typed_time = _pg_time_type(con, "station_3h").startswith("timestamp")
+        return con.execute(_recompute_3h_pg(typed_time), {"t0": t0_s}).rowcount
+    df = pd.read_sql(_READ_RAW_3H_STMT, con, params={"t0": t0_s})
 
     if df.empty:
         return 0
 
-    # Column canonicalization (case-insensitive)
-    cols = {c.lower(): c for c in df.columns}
-    def col(name): return cols.get(name)
-    time_col = col("time") or col("ts_utc") or col("timestamp")
-    if not time_col:
-        return 0
+    df["time"] = pd.to_datetime(df["time"], utc=True, errors="coerce")
+    df = df.dropna(subset=["time"]).sort_values("time")
 
-    df[time_col] = pd.to_datetime(df[time_col], utc=True, errors="coerce")
-    df = df.dropna(subset=[time_col]).sort_values(time_col)
-
-    # allineo t0 al bordo 3H per aggiornare bucket completo
-    t0_aligned = df[time_col].min().floor("3H")
-    df = df[df[time_col] >= t0_aligned]
-
-    # rename to canonical expected names
-    rename_map = {}
-    for k in ["temp_c","humidity","pressure_hpa","wind_kmh","windgust_kmh","rain_mm"]:
-        if col(k):
-            rename_map[col(k)] = k
-    df = df.rename(columns=rename_map)
-
-    agg = (df.set_index(time_col)
+    agg = (df.set_index("time")
              .resample("3H")
-             .agg({
-                 "temp_c":"mean",
-                 "humidity":"mean",
-                 "pressure_hpa":"mean",
-                 "wind_kmh":"mean",
-                 "windgust_kmh":"max",
-                 "rain_mm":"sum"
-             })
+             .agg(_AGG_3H)
              .reset_index()
           )
-    agg = agg.rename(columns={time_col: "time"})
     agg["time"] = pd.to_datetime(agg["time"], utc=True, errors="coerce").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-    records = agg.to_dict("records")
+    records = agg.astype(object).where(agg.notna(), None).to_dict("records")
     if not records:
         return 0
 
-    stmt = text("""
-        INSERT INTO station_3h (time, temp_c, humidity, pressure_hpa, wind_kmh, windgust_kmh, rain_mm)
-        VALUES (:time, :temp_c, :humidity, :pressure_hpa, :wind_kmh, :windgust_kmh, :rain_mm)
-        ON CONFLICT (time) DO UPDATE SET
-          temp_c=excluded.temp_c,
-          humidity=excluded.humidity,
-          pressure_hpa=excluded.pressure_hpa,
-          wind_kmh=excluded.wind_kmh,
-          windgust_kmh=excluded.windgust_kmh,
-          rain_mm=excluded.rain_mm;
-    """)
-    with engine().begin() as con:
-        for chunk in _chunked(records, chunk_size=2000):
-            con.execute(stmt, chunk)
+    for chunk in _chunked(records, chunk_size=2000):
+        con.execute(_UPSERT_3H_STMT, chunk)
     return len(records)
 
-def touch_last_ingest():
-    with engine().begin() as con:
-        con.execute(text("""
-            INSERT INTO meta (k, v) VALUES ('last_ingest', :v)
-            ON CONFLICT (k) DO UPDATE SET v=excluded.v
-        """), {"v": pd.Timestamp.utcnow().isoformat()})
+def touch_last_ingest(con):
+    con.execute(_TOUCH_STMT, {"v": pd.Timestamp.utcnow().isoformat()})
 
 # -------------------- Main --------------------
 def main():
@@ -348,20 +495,26 @@ def main():
 
     ensure_schema()
 
+    # inizio della finestra 3h da ricalcolare: minimo tra i timestamp *effettivamente* scritti
     window_start_utc: Optional[pd.Timestamp] = None
 
+    def _mark_written(tmin_new: Optional[str]) -> None:
+        nonlocal window_start_utc
+        tmin = pd.to_datetime(tmin_new, utc=True, errors="coerce")
+        if not pd.isna(tmin):
+            window_start_utc = tmin if window_start_utc is None else min(window_start_utc, tmin)
+
+    # Prima tutte le chiamate di rete, poi un'unica transazione per le scritture
+    # (niente transazione aperta mentre si aspetta l'API Ecowitt)
+    df_rt = pd.DataFrame()
+    df_all = pd.DataFrame()
+    n_days = 0
+
     # Realtime
     try:
         rt = ecowitt_get("device/real_time", {"mac": MAC, "call_back": "outdoor,wind,pressure,rainfall"})
         df_rt = parse_payload(rt)
         if not df_rt.empty:
-            upsert_raw(df_rt.tail(1))
-            try:
-                tmin = pd.to_datetime(df_rt['time'].min(), utc=True, errors='coerce')
-                if not pd.isna(tmin):
-                    window_start_utc = tmin if window_start_utc is None else min(window_start_utc, tmin)
-            except Exception:
-                pass
             last = df_rt.iloc[-1].to_dict()
             log.info(
                 "REALTIME: T=%.2f°C H=%.0f%% P=%.1f hPa V=%.2f km/h G=%s dir=%s",
@@ -377,51 +530,78 @@ def main():
     except Exception as e:
         log.warning("Realtime error: %s", e)
 
-    # Backfill (giorno per giorno)
+    # Backfill (giorni richiesti in parallelo, I/O-bound)
     if BACKFILL_HOURS > 0:
         now = datetime.now(timezone.utc)
         start = now - timedelta(hours=BACKFILL_HOURS)
-        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
-        while day <= now:
-            try:
-                hist = ecowitt_get(
-                    "device/history",
-                    {
-                        "mac": MAC,
-                        "start_date": day.strftime("%Y-%m-%d 00:00:00"),
-                        "end_date": min(now, day + timedelta(days=1) - timedelta(seconds=1)).strftime("%Y-%m-%d %H:%M:%S"),
-                        "call_back": "outdoor,wind,pressure,rainfall",
-                    },
+        # giorni UTC calcolati in un colpo solo; l'ultimo si chiude a "now"
+        days = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(now).normalize(), freq="D")
+        ranges = [(day, min(now, day + _DAY_LAST_SECOND)) for day in days]
+
+        with ThreadPoolExecutor(max_workers=HISTORY_WORKERS) as ex:
+            results = list(ex.map(_fetch_history_day, ranges))
+
+        frames: List[pd.DataFrame] = []
+        # log nell'ordine dei giorni, indipendentemente dall'ordine di completamento
+        for (day, _), (df_h, err) in zip(ranges, results):
+            if err is not None:
+                log.warning("History %s error: %s", day.date(), err)
+                continue
+            if not df_h.empty:
+                frames.append(df_h)
+                last = df_h.iloc[-1].to_dict()
+                log.info(
+                    "HISTORY %s: rows=%s ultimo T=%.2f°C P=%.1f hPa V=%.2f km/h",
+                    day.date(), len(df_h),
+                    (last.get("temp_c") or float("nan")),
+                    (last.get("pressure_hpa") or float("nan")),
+                    (last.get("wind_kmh") or 0.0),
                 )
-                df_h = parse_payload(hist)
-                cnt = upsert_raw(df_h)
-                try:
-                    tmin = pd.to_datetime(df_h['time'].min(), utc=True, errors='coerce')
-                    if not pd.isna(tmin):
-                        window_start_utc = tmin if window_start_utc is None else min(window_start_utc, tmin)
-                except Exception:
-                    pass
-                if not df_h.empty:
-                    last = df_h.iloc[-1].to_dict()
-                    log.info(
-                        "HISTORY %s: rows=%s ultimo T=%.2f°C P=%.1f hPa V=%.2f km/h",
-                        day.date(), cnt,
-                        (last.get("temp_c") or float("nan")),
-                        (last.get("pressure_hpa") or float("nan")),
-                        (last.get("wind_kmh") or 0.0),
-                    )
+
+        if frames:
+            df_all = pd.concat(frames, ignore_index=True).drop_duplicates(subset=["time"]).sort_values("time")
+            n_days = len(frames)
+
+    # Scritture: una sola transazione (un BEGIN/COMMIT per ciclo, anche su SQLite: vedi db.enable_sqlite_wal);
+    # ogni fase in un savepoint, così un errore nel realtime non annulla backfill, ricalcolo e meta
+    with engine().begin() as con:
+        if not df_rt.empty:
+            try:
+                with con.begin_nested():
+                    _, tmin_new = upsert_raw(con, df_rt.tail(1))
+                _mark_written(tmin_new)
             except Exception as e:
-                log.warning("History %s error: %s", day.date(), e)
-            day += timedelta(days=1)
+                log.warning("Realtime upsert error: %s", e)
 
-    # Ricostruisci 3h
-    try:
-        n3 = recompute_3h(window_start_utc=window_start_utc, lookback_hours=max(96, BACKFILL_HOURS))
-        log.info("station_3h ricostruita: %s bucket", n3)
-    except Exception as e:
-        log.warning("Recompute 3h error: %s", e)
+        # Un solo upsert per tutto il backfill (batch grandi invece di una transazione al giorno)
+        if not df_all.empty:
+            try:
+                with con.begin_nested():
+                    cnt, tmin_new = upsert_raw(con, df_all)
+                log.info("HISTORY: upsert %s righe (%s giorni)", cnt, n_days)
+                _mark_written(tmin_new)
+            except Exception as e:
+                log.warning("History upsert error: %s", e)
+
+        # Ricostruisci 3h solo se qualcosa è cambiato (o se station_3h è rimasta indietro
+        # rispetto a station_raw per un ricalcolo fallito), e solo dai bucket toccati
+        stale = False
+        if window_start_utc is None:
+            raw_max, last3h = _max_time(con, _MAX_RAW_STMT), _max_time(con, _MAX_3H_STMT)
+            stale = raw_max is not None and (last3h is None or raw_max >= last3h + pd.Timedelta(hours=3))
+        if window_start_utc is None and not stale:
+            log.info("Nessuna riga nuova: station_3h invariata.")
+        else:
+            try:
+                with con.begin_nested():
+                    n3 = recompute_3h(con, window_start_utc=window_start_utc, lookback_hours=max(96, BACKFILL_HOURS))
+                log.info("station_3h ricostruita: %s bucket", n3)
+            except Exception as e:
+                log.warning("Recompute 3h error: %s", e)
 
-    touch_last_ingest()
+        touch_last_ingest(con)
+    # niente pagine lasciate nel -wal: il .db è completo se viene copiato/committato dopo il run
+    sqlite_checkpoint(engine())
     log.info("Done.")
 
 if __name__ == "__main__":
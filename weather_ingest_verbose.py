@@ -1,12 +1,14 @@
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import pandas as pd
 import numpy as np
-import requests
 from sqlalchemy import create_engine, text as sqltext
 from dotenv import load_dotenv
 
-from ecowitt_api import get_real_time, get_history, real_time_to_df, history_to_df
+from ecowitt_api import SESSION, get_real_time, get_history, real_time_to_df, history_to_df
+from db import exec_script, to_sql_upsert
 
 print("=== Ingest Verbose v3 ===")
 
@@ -52,33 +54,24 @@ def ensure_db(engine):
       v TEXT
     );
     """
+    # tutto lo schema in un solo round-trip (executescript su SQLite)
     with engine.begin() as conn:
-        for stmt in schema.split(";"):
-            s = stmt.strip()
-            if s:
-                conn.execute(sqltext(s))
+        exec_script(conn, schema)
 
 def upsert_table(engine, df, table, pk="Time"):
     if df is None or df.empty:
         return 0
-    ins = 0
+    # to_sql fa conversione NaN -> NULL e chunking; ogni chunk è una executemany ON CONFLICT
     with engine.begin() as conn:
-        placeholders = ",".join([":" + c for c in df.columns])
-        cols = ",".join(df.columns)
-        update_clause = ",".join([f"{c}=excluded.{c}" for c in df.columns if c != pk])
-        sql = sqltext(f"INSERT INTO {table} ({cols}) VALUES ({placeholders}) "
-                   f"ON CONFLICT({pk}) DO UPDATE SET {update_clause}")
-        for _, row in df.iterrows():
-            conn.execute(sql, row.to_dict())
-            ins += 1
-    return ins
+        return df.to_sql(table, conn, if_exists="append", index=False, chunksize=1000,
+                         method=to_sql_upsert(pk)) or 0
 
 def fetch_openweather(api_key, lat, lon):
     if not api_key or not lat or not lon:
         print("SKIP OW: missing api_key or lat/lon")
         return pd.DataFrame()
     params = {"lat": lat, "lon": lon, "appid": api_key, "units": "metric"}
-    r = requests.get(FORECAST_URL, params=params, timeout=30)
+    r = SESSION.get(FORECAST_URL, params=params, timeout=30)
     print("OW status:", r.status_code, r.reason)
     r.raise_for_status()
     data = r.json()
@@ -106,50 +99,105 @@ def mac_variants(mac):
     if not mac:
         return []
     m = mac.replace(":", "").replace("-", "")
-    return [mac, mac.upper(), mac.lower(), m, m.upper(), m.lower()]
+    # senza duplicati (es. MAC già maiuscolo), nell'ordine di prova
+    return list(dict.fromkeys([mac, mac.upper(), mac.lower(), m, m.upper(), m.lower()]))
+
+BACKFILL_WORKERS = 4  # giorni scaricati in parallelo (I/O-bound)
+CYCLES = [None, "30min", "5min", "1hour", "240min"]
+AGG_3H = {"Temp_C":"mean","Humidity":"mean","Pressure_hPa":"mean","Wind_kmh":"mean","Rain_mm":"sum"}
+SMALL_BATCH_ROWS = 64  # sotto questa soglia i bucket 3h si fanno in puro Python
+BUCKET_S = 3 * 3600
+
+def _bucket_3h_small(df):
+    """Come resample("3h").agg(AGG_3H) ma senza la macchina di pandas, per i pochi campioni di un giorno.
+
+    Produce gli stessi bucket (anche quelli vuoti fra il primo e l'ultimo), ignora i NaN,
+    somma vuota = 0; None se il frame non è adatto (Time con tz, colonne mancanti o non numeriche).
+    """
+    if df["Time"].dtype.kind != "M" or df["Time"].dt.tz is not None:
+        return None
+    if any(c not in df.columns or df[c].dtype.kind not in "fiu" for c in AGG_3H):
+        return None
+    buckets = (df["Time"].to_numpy("datetime64[s]").astype("int64") // BUCKET_S * BUCKET_S).tolist()
+    acc = defaultdict(lambda: {c: [] for c in AGG_3H})
+    for c in AGG_3H:
+        for b, v in zip(buckets, df[c].tolist()):
+            if v == v:  # salta NaN
+                acc[b][c].append(v)
+    rows = []
+    for b in range(buckets[0], buckets[-1] + 1, BUCKET_S):
+        vals = acc.get(b) or {c: [] for c in AGG_3H}
+        row = {"Time": datetime.fromtimestamp(b, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+        for c, how in AGG_3H.items():
+            v = vals[c]
+            row[c] = sum(v) if how == "sum" else (sum(v) / len(v) if v else np.nan)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def _backfill_day(app, key, mac, start, end, cycles=CYCLES):
+    """Scarica e aggrega a 3h un giorno, provando i cycle_type in ordine.
+
+    Ritorna (df3h o None, righe di log, cycle usato); gira nel thread pool, quindi non stampa né scrive su DB.
+    """
+    logs = []
+    for cycle in cycles:
+        try:
+            payload = get_history(app, key, mac, start, end,
+                                  call_back="outdoor,wind,pressure,rainfall",
+                                  cycle_type=cycle)
+            df = history_to_df(payload)
+            if df is None or df.empty:
+                continue
+            # convert wind to km/h, resample to 3h and upsert
+            if "Wind_mps" in df.columns:
+                df["Wind_kmh"] = df["Wind_mps"] * 3.6
+            if "Time" not in df.columns:
+                continue
+            df = df.dropna(subset=["Time"]).sort_values("Time").drop_duplicates("Time")
+            df3h = _bucket_3h_small(df) if 0 < len(df) < SMALL_BATCH_ROWS else None
+            if df3h is None:
+                df3h = (df.set_index("Time")
+                          .resample("3H")
+                          .agg(AGG_3H)
+                          .reset_index())
+                if df3h.empty:
+                    continue
+                df3h["Time"] = pd.to_datetime(df3h["Time"]).dt.tz_localize("UTC").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+            df3h["WindGust_kmh"] = None
+            df3h = df3h[["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","Rain_mm"]]
+            logs.append(f"    - {start:%Y-%m-%d} cycle={cycle or 'default'} -> {len(df3h)} rows")
+            return df3h, logs, cycle
+        except Exception as e:
+            logs.append(f"    x {start:%Y-%m-%d} cycle={cycle or 'default'} ERROR: {e}")
+    logs.append(f"    ! Nessun dato per {start:%Y-%m-%d}")
+    return None, logs, None
 
 def ecowitt_backfill(engine, app, key, mac, days=7):
     total = 0
     now = datetime.now()
+    windows = [(now - timedelta(days=i) - timedelta(days=1), now - timedelta(days=i)) for i in range(days)]
     for mac_try in mac_variants(mac):
         print(f"  * Provo MAC: {mac_try}")
-        for i in range(days):
-            end = now - timedelta(days=i)
-            start = end - timedelta(days=1)
-            success = False
-            for cycle in [None, "30min", "5min", "1hour", "240min"]:
-                try:
-                    payload = get_history(app, key, mac_try, start, end,
-                                          call_back="outdoor,wind,pressure,rainfall",
-                                          cycle_type=cycle)
-                    df = history_to_df(payload)
-                    if df is None or df.empty:
-                        continue
-                    # convert wind to km/h, resample to 3h and upsert
-                    if "Wind_mps" in df.columns:
-                        df["Wind_kmh"] = df["Wind_mps"] * 3.6
-                    if "Time" not in df.columns:
-                        continue
-                    df = df.dropna(subset=["Time"]).sort_values("Time").drop_duplicates("Time")
-                    df3h = (df.set_index("Time")
-                              .resample("3H")
-                              .agg({"Temp_C":"mean","Humidity":"mean","Pressure_hPa":"mean",
-                                    "Wind_kmh":"mean","Rain_mm":"sum"})
-                              .reset_index())
-                    if df3h.empty:
-                        continue
-                    df3h["Time"] = pd.to_datetime(df3h["Time"]).dt.tz_localize("UTC").dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-                    df3h["WindGust_kmh"] = None
-                    df3h = df3h[["Time","Temp_C","Humidity","Pressure_hPa","Wind_kmh","WindGust_kmh","Rain_mm"]]
-                    n = upsert_table(engine, df3h, "station_3h")
-                    total += n
-                    print(f"    - {start:%Y-%m-%d} cycle={cycle or 'default'} -> {len(df3h)} rows (inserted {n})")
-                    success = True
-                    break
-                except Exception as e:
-                    print(f"    x {start:%Y-%m-%d} cycle={cycle or 'default'} ERROR: {e}")
-            if not success:
-                print(f"    ! Nessun dato per {start:%Y-%m-%d}")
+        # sonda sul giorno più recente: se il MAC non risponde non provo gli altri giorni,
+        # altrimenti il cycle che ha funzionato vale per tutti
+        probe = _backfill_day(app, key, mac_try, *windows[0])
+        cycle_ok = probe[2]
+        results = [probe]
+        if probe[0] is not None and len(windows) > 1:
+            # giorni indipendenti: richieste in parallelo, log e scrittura nel thread principale
+            with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as ex:
+                results += ex.map(lambda w: _backfill_day(app, key, mac_try, *w, cycles=[cycle_ok]), windows[1:])
+        frames = []
+        for df3h, logs, _cycle in results:
+            for line in logs:
+                print(line)
+            if df3h is not None:
+                frames.append(df3h)
+        if frames:
+            # un solo upsert per tutti i giorni (i bucket ai bordi del giorno coincidono: vince l'ultimo, come prima)
+            df_all = pd.concat(frames, ignore_index=True).drop_duplicates("Time", keep="last")
+            total += upsert_table(engine, df_all, "station_3h")
+            print(f"    = upsert {total} rows ({len(frames)} giorni)")
         if total > 0:
             break
     return total